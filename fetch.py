@@ -1,24 +1,34 @@
 from config import APIKEY
 
 from decimal import Decimal as D
-from collections import deque
-from typing import List
+from collections import defaultdict
+from functools import lru_cache
+from typing import Iterator
+from datetime import datetime
+import atexit
+import os
 
 import sqlalchemy.types as types
 
 import sqlalchemy as sa
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.orm import declarative_base, relationship
+from sqlalchemy.orm import declarative_base, relationship, aliased
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import time
 
 import rfc3339
 
 class SqliteNumeric(types.TypeDecorator):
     """
     Custom type for storing Decimals as string in SQLite.
-    Otherwise SQLAlchemy complains about rounding
+    Otherwise SQLAlchemy complains about rounding,
+    and SQLite would store them as REAL, losing precision.
     """
     impl = types.String
+    # no state, so compiled statements using this type can be cached
+    cache_ok = True
     def process_bind_param(self, value, dialect):
         return str(value)
     def process_result_value(self, value, dialect):
@@ -27,30 +37,56 @@ class SqliteNumeric(types.TypeDecorator):
         else:
             return D()
 
+def parse_timestamp(value: str) -> datetime:
+    """
+    Parse a RFC 3339 timestamp, as sent by Bitpanda.
+    Much faster than rfc3339.parse_datetime, since it's done in C.
+    """
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
 class RfcTimestamp(types.TypeDecorator):
     """
     Save date/time as string in SQLite.
     This way, I can handle formatting and timezone-awareness.
     """
     impl = types.String
+    cache_ok = True
 
     def process_bind_param(self, value, dialect):
-        if type(value) is str:
-            value = rfc3339.parse_datetime(value)
+        # usual case, checked first
+        if isinstance(value, datetime):
+            return value.isoformat()
 
         if value:
-            return value.isoformat()
+            return parse_timestamp(value).isoformat()
         else:
             return None
 
     def process_result_value(self, value, dialect):
-        return rfc3339.parse_datetime(value)
+        return parse_timestamp(value)
+
+engine = sa.create_engine("sqlite:///transactions.db", echo=False, future=True)
+
+# WAL, so reads don't block the writer, and cheaper commits
+@sa.event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.execute("PRAGMA busy_timeout=30000")
+    cursor.close()
+
+@atexit.register
+def _optimize_db():
+    with engine.connect() as conn:
+        conn.exec_driver_sql("PRAGMA optimize")
 
-engine = sa.create_engine("sqlite:///transactions.db", echo=True, future=True)
 Session = sessionmaker(engine)
 Base = declarative_base()
-#for debug only
-resp={}
+#for debug only, set DEBUG_RESP to keep the last API response here
+last_resp=None
 
 ####################################################################################
 from sqlalchemy.ext.compiler import compiles
@@ -74,6 +110,24 @@ class FiatTransfer(Base):
     amount              = sa.Column(SqliteNumeric)
     timestamp           = sa.Column(RfcTimestamp)
 
+def trade_balance_left(t):
+    """
+    Balance change of the left side of a trade, usually Crypto.
+    Positive if BUY, negative if SELL.
+    Works on Trade objects as well as plain rows with the trade columns.
+    """
+    is_sale = t.transaction_type == "SELL"
+    if is_sale:
+        value = -1 * t.amount
+    else:
+        value = t.amount
+
+    # in case of "buy", the fee is on the crypto
+    if not is_sale and not t.is_best_fee:
+        value -= t.fee
+
+    return value
+
 class Trade(Base):
     """
     This is a trade / exchange.
@@ -95,6 +149,16 @@ class Trade(Base):
     fee                 = sa.Column(SqliteNumeric)
     fee_currency        = sa.Column(sa.String)
 
+    __table_args__ = (
+        # first BUY of each pair in get_current_balances
+        sa.Index("ix_trade_pair_ts", "trade_pair", "timestamp"),
+        # get_trade_rows / get_all_trades, ordered by time,
+        # the id makes the order of trades at the same time deterministic
+        sa.Index("ix_trade_ts_id", "timestamp", "id"),
+        # get_bestfee_total
+        sa.Index("ix_trade_isbest", "is_best_fee"),
+    )
+
     @property
     def is_sale(self):
         return self.transaction_type == "SELL"
@@ -105,16 +169,7 @@ class Trade(Base):
         Balance change of the left side, usually Crypto.
         Positive if BUY, negative if SELL
         """
-        if self.is_sale:
-            value = -1 * self.amount
-        else:
-            value = self.amount
-
-        # in case of "buy", the fee is on the crypto
-        if not self.is_sale and not self.is_best_fee:
-            value -= self.fee
-
-        return value
+        return trade_balance_left(self)
 
     @property
     def balance_right(self):
@@ -141,97 +196,172 @@ class Trade(Base):
         return f"Trade(id={self.id[:6]}..., trade_pair={self.trade_pair!r}, transaction_type={self.transaction_type!r}, amount={self.amount!r}, price={self.price!r})"
 
 Base.metadata.create_all(engine)
+# create_all skips existing tables, so add indexes missing in older databases
+for index in Trade.__table__.indexes:
+    index.create(engine, checkfirst=True)
+# replaced by ix_trade_ts_id
+with engine.begin() as conn:
+    conn.exec_driver_sql("DROP INDEX IF EXISTS ix_trade_ts")
+
+_http = None
+
+def get_http_session() -> requests.Session:
+    """
+    Get the HTTP session shared by all API requests,
+    so the TCP+TLS connection is reused across pages
+    """
+    global _http
+
+    if _http is None:
+        _http = requests.Session()
+        _http.headers.update({'User-Agent': 'PyBitPandaFetcher'})
+        _http.headers.update({"Authorization": "Bearer "+APIKEY})
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=4,
+            max_retries=Retry(total=5, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+        )
+        _http.mount("https://", adapter)
+
+    return _http
+
+def _get_json(s, url, params):
+    """
+    GET from the API, returning the parsed JSON
+    """
+    global last_resp
+
+    resp=s.get(url, params=params)
+    resp.raise_for_status()
+    if __debug__ and os.environ.get("DEBUG_RESP"):
+        last_resp=resp
+    return resp.json()
+
+@lru_cache(maxsize=4096)
+def _D(value: str) -> D:
+    """
+    Decimal from the API, cached. Many trades share the same price / amount / fee.
+    Decimals are immutable, so sharing them is fine.
+    """
+    return D(value)
+
+def _persist_rows(session, rows):
+    """
+    Write one page of imported trades.
+    One executemany instead of the ORM unit of work, INSERT OR IGNORE still applies
+    """
+    session.execute(sa.insert(Trade), rows)
 
 def import_trades():
     """
     Import trades from Bitpanda API
     """
-    global resp
-
-    with Session() as session:
+    # one transaction for the whole import, committed at the end
+    with Session.begin() as session:
         result = session.execute(
             sa.select(Trade).order_by(sa.desc("timestamp"))
         )
         latest = result.scalars().first()
 
-    cursor=None
-    s=requests.session()
-    s.headers.update({'User-Agent': 'PyBitPandaFetcher'})
-    s.headers.update({"Authorization": "Bearer "+APIKEY})
-
-    alltrades=[]
-    ppppage=1
-    while True:
-        ppppage += 1
-        print(f"Fetching page {ppppage}")
-        url='https://api.exchange.bitpanda.com/public/v1/account/trades'
-        p={"max_page_size": 30}
+        cursor=None
+        s=get_http_session()
+
+        # same time range for all pages
         if latest:
-            p["from"]=latest.timestamp.isoformat()
-            p["to"]=rfc3339.now().isoformat()
-        if cursor:
-            p["cursor"] = cursor
-        resp=s.get(url, params=p)
-        if resp.status_code != 200:
-            raise ValueError("Invalid status code")
-
-        j=resp.json()
-
-        trades = j["trade_history"]
-        for trade in trades:
-            t=trade["trade"]
-
-            ormtrade=Trade(
-                id=t["trade_id"],
-                trade_pair=t["instrument_code"],
-                transaction_type=t["side"], #BUY, SELL
-                amount=D(t["amount"]),
-                price=D(t["price"]),
-                timestamp=rfc3339.parse_datetime(t["time"])
-            )
-
-            (tradee, traded) = t["instrument_code"].split("_")
-            # switch currencies
-            if t["side"] == "SELL":
-                (tradee, traded) = (traded, tradee)
-
-            f=trade["fee"]
-            if f["collection_type"] == "BEST":
-                ormtrade.is_best_fee = True
-                ormtrade.fee = D(f["fee_amount"])
-                ormtrade.fee_currency = f["fee_currency"]
-            elif f["collection_type"] == "STANDARD":
-                ormtrade.is_best_fee = False
-                #fee_amount, fee_currency
-                if f["fee_currency"] != tradee:
-                    raise ValueError("Something appears to be wrong with the fee")
-                ormtrade.fee = D(f["fee_amount"])
-                ormtrade.fee_currency = f["fee_currency"]
-            else:
-                raise ValueError("Unknown fee collection type")
+            time_from=latest.timestamp.isoformat()
+            time_to=rfc3339.now().isoformat()
+
+        ppppage=1
+        while True:
+            ppppage += 1
+            print(f"Fetching page {ppppage}")
+            url='https://api.exchange.bitpanda.com/public/v1/account/trades'
+            p={"max_page_size": 30}
+            if latest:
+                p["from"]=time_from
+                p["to"]=time_to
+            if cursor:
+                p["cursor"] = cursor
+            j=_get_json(s, url, p)
+
+            rows=[]
+            trades = j["trade_history"]
+            for trade in trades:
+                t=trade["trade"]
+
+                row=dict(
+                    id=t["trade_id"],
+                    trade_pair=t["instrument_code"],
+                    transaction_type=t["side"], #BUY, SELL
+                    amount=_D(t["amount"]),
+                    price=_D(t["price"]),
+                    timestamp=parse_timestamp(t["time"])
+                )
+
+                (tradee, traded) = t["instrument_code"].split("_")
+                # switch currencies
+                if t["side"] == "SELL":
+                    (tradee, traded) = (traded, tradee)
+
+                f=trade["fee"]
+                if f["collection_type"] == "BEST":
+                    row["is_best_fee"] = True
+                    row["fee"] = _D(f["fee_amount"])
+                    row["fee_currency"] = f["fee_currency"]
+                elif f["collection_type"] == "STANDARD":
+                    row["is_best_fee"] = False
+                    #fee_amount, fee_currency
+                    if f["fee_currency"] != tradee:
+                        raise ValueError("Something appears to be wrong with the fee")
+                    row["fee"] = _D(f["fee_amount"])
+                    row["fee_currency"] = f["fee_currency"]
+                else:
+                    raise ValueError("Unknown fee collection type")
 
-            alltrades.append(ormtrade)
+                rows.append(row)
 
-        if not "cursor" in j:
-            break
-        else:
-            cursor=j["cursor"]
+            if rows:
+                _persist_rows(session, rows)
 
+            if not "cursor" in j:
+                break
+            else:
+                cursor=j["cursor"]
+                # be nice to the API
+                time.sleep(0.05)
+
+def get_all_trades() -> Iterator[Trade]:
+    """
+    Get all trades, ordered by time.
+    The trades are streamed from the database while iterating.
+    """
     with Session() as session:
-        session.add_all(alltrades)
-        session.commit()
-        pass
+        result = session.execute(
+            sa.select(Trade).order_by(Trade.timestamp, Trade.id)
+            .execution_options(stream_results=True, yield_per=1000)
+        )
+        for trade in result.scalars():
+            yield trade
 
-def get_all_trades() -> List[Trade]:
+def get_trade_rows() -> Iterator[sa.Row]:
     """
-    Get all trades, returning a list
+    Stream all trades as plain rows, ordered by time and id,
+    the same order as in FIFO_GAIN_SQL.
+    Only the columns needed for the calculations are loaded,
+    no ORM objects are built.
     """
+    stmt = sa.select(
+        Trade.id, Trade.trade_pair, Trade.transaction_type,
+        Trade.amount, Trade.price, Trade.timestamp,
+        Trade.is_best_fee, Trade.fee
+    ).order_by(Trade.timestamp, Trade.id)
+
     with Session() as session:
         result = session.execute(
-            sa.select(Trade).order_by("timestamp")
+            stmt.execution_options(stream_results=True, yield_per=2000)
         )
-        alltrades = result.scalars().all()
-        return alltrades
+        for row in result:
+            yield row
 
 def get_all_fiat():
     """
@@ -239,93 +369,347 @@ def get_all_fiat():
     """
     with Session() as session:
         result = session.execute(
-            sa.select(FiatTransfer).order_by("timestamp")
+            sa.select(FiatTransfer.id, FiatTransfer.amount, FiatTransfer.timestamp)
+            .order_by(FiatTransfer.timestamp)
         )
-        allfiat = result.scalars().all()
+        allfiat = result.all()
         return allfiat
 
 from sqlalchemy import func
 
+# Decimal places for sums done by SQLite.
+# Summing the strings would give floats, so the values are scaled and
+# rounded to ints first. Digits beyond SQL_FIXED_DIGITS are rounded away,
+# and each value is only exact below about 9*10^7 (2^53 / 10^8).
+SQL_FIXED_DIGITS = 8
+
+def sql_fixed(column):
+    """
+    SQL expression for a Decimal column as int with SQL_FIXED_DIGITS decimal places
+    """
+    return sa.cast(func.round(sa.cast(column, sa.Float) * 10**SQL_FIXED_DIGITS), sa.Integer)
+
 def get_bestfee_total():
     """
-    Simply sum all the BEST fees
+    Simply sum all the BEST fees.
+    Each fee is rounded to SQL_FIXED_DIGITS decimal places, see sql_fixed.
     """
     with Session() as session:
-        result = session.execute(sa.select(func.sum(Trade.fee)).where(Trade.is_best_fee==True))
-        return result.scalars().one()
+        result = session.execute(sa.select(func.sum(sql_fixed(Trade.fee))).where(Trade.is_best_fee==True))
+        return from_fixed(result.scalars().one() or 0, SQL_FIXED_DIGITS)
 
 def get_current_balances():
     """
-    Get the current balances of each coin
+    Get the current balances of each coin.
+    Summed by SQLite: each amount and fee is rounded to SQL_FIXED_DIGITS (8)
+    decimal places, and is only exact below about 9*10^7 coins per trade.
+    Unlike calc_fifo, extra decimal places are not an error.
     """
-    trades=get_all_transactions()
-    currencies={}
-    for t in trades:
-        if t.is_sale and not t.trade_pair in currencies:
+    amount = sql_fixed(Trade.amount)
+    balance_left = sa.case(
+        (Trade.transaction_type == "SELL", -amount),
+        (Trade.is_best_fee == True, amount),
+        # in case of "buy", the fee is on the crypto
+        else_=amount - sql_fixed(Trade.fee)
+    )
+
+    # Sales before the first BUY of the pair are ignored,
+    # e.g. coins that were never bought on this exchange
+    buys = aliased(Trade)
+    first_buy = (
+        sa.select(func.min(buys.timestamp))
+        .where(buys.trade_pair == Trade.trade_pair, buys.transaction_type == "BUY")
+        .scalar_subquery()
+    )
+    ignored = sa.and_(
+        Trade.transaction_type == "SELL",
+        sa.or_(first_buy.is_(None), Trade.timestamp < first_buy)
+    )
+
+    with Session() as session:
+        result = session.execute(
+            sa.select(Trade.trade_pair, Trade.amount)
+            .where(ignored)
+            .order_by(Trade.timestamp)
+        )
+        for t in result:
             print(f"Ignoring Sale of {t.amount} {t.trade_pair.split('_')[0]}")
-        elif not t.is_sale:
-            currencies[t.trade_pair] = \
-                currencies.get(t.trade_pair, 0) + t.balance_left
-        elif t.is_sale:
-            currencies[t.trade_pair] += t.balance_left
-            if currencies[t.trade_pair] < 0:
-                print("WARNING: Balance below 0 - how?")
-        else:
-            raise ValueError("Invalid condition")
 
-    currencies["BEST_EUR"] = currencies.get("BEST_EUR", 0) - get_bestfee_total()
+        result = session.execute(
+            sa.select(Trade.trade_pair, func.sum(balance_left))
+            .where(sa.not_(ignored))
+            .group_by(Trade.trade_pair)
+        )
+        currencies = {pair: from_fixed(balance, SQL_FIXED_DIGITS) for (pair, balance) in result}
+
+    for (pair, balance) in currencies.items():
+        if balance < 0:
+            print(f"WARNING: Balance of {pair} below 0 - how?")
+
+    currencies["BEST_EUR"] = currencies.get("BEST_EUR", D()) - get_bestfee_total()
 
     return currencies
 
-def calc_fifo():
-    trades : List[Trade] = get_all_transactions()
-    #trades = list(filter(lambda x: x.trade_pair == "PAN_EUR", trades))
-    # dict containing dequeues for each currency
-    fifo={}
-    allgain = D()
-    for t in trades:
-        if t.is_sale:
-            # no default value -  a BUY *MUST* be present!
-            q : deque[Trade] = fifo.get(t.trade_pair)
-
-            # invert sign to be positive, since this a sale
-            t.remaining = -1 * t.balance_left
-            assert(t.remaining == t.amount)
-
-            while t.remaining > 0:
-                matching_trade : Trade = q.popleft()
-
-                if matching_trade.remaining >= t.remaining:
-                    amnt = t.remaining
-                    matching_trade.remaining -= t.remaining
-                    t.remaining = 0
-
-                    if matching_trade.remaining > 0:
-                        # can be put back after subtracting
-                        q.appendleft(matching_trade)
-                else:
-                    # not sufficient volume in current BUY transaction - fetch another one next loop
-                    amnt = matching_trade.remaining
-                    t.remaining -= matching_trade.remaining
-                    matching_trade.remaining = 0
-
-                buy = matching_trade.price * amnt
-                sell = t.price * amnt
-                # TODO
-                fees = D()
-                if t.is_sale and not t.is_best_fee:
-                    fees = amnt / (-1 * t.balance_left) * t.fee
-
-                print(f"CURRENCY: {t.currency}\tAMOUNT: {amnt:10.3f}\tBUY: {buy:10.3f} EUR\tSELL: {sell:10.3f} EUR\tFEE: {fees:10.3f} EUR\tGAIN: {(sell - buy - fees):10.3f} EUR")
-
-                allgain += sell - buy - fees
-            if t.remaining < 0:
-                print("ERROR - balance shouldn't be below 0")
+# FIFO matching done entirely in SQLite:
+# Per trade pair, all sales together use up the first "sold" units of
+# the bought volume, in order. So each BUY is used up by
+#   max(0, min(bought up to and including it, sold) - bought before it)
+# which needs just one pass with a window function, no join of buys and sells.
+# If at any trade more was sold than bought up to then,
+# something was sold before it was bought; counted in "unmatched".
+# Values are scaled to ints like sql_fixed does, the query returns
+# the volume per price, price * volume is summed exactly in Python.
+FIFO_GAIN_SQL = sa.text("""
+WITH legs AS (
+    SELECT
+        id,
+        trade_pair,
+        transaction_type,
+        timestamp,
+        CAST(ROUND(CAST(price AS REAL) * {scale}) AS INTEGER) AS price,
+        CASE
+            WHEN transaction_type = 'SELL' OR is_best_fee THEN CAST(ROUND(CAST(amount AS REAL) * {scale}) AS INTEGER)
+            -- in case of "buy", the fee is on the crypto
+            ELSE CAST(ROUND(CAST(amount AS REAL) * {scale}) AS INTEGER) - CAST(ROUND(CAST(fee AS REAL) * {scale}) AS INTEGER)
+        END AS qty,
+        CASE
+            -- in case of "sell", the fee is on the fiat
+            WHEN transaction_type = 'SELL' AND NOT is_best_fee THEN CAST(ROUND(CAST(fee AS REAL) * {scale}) AS INTEGER)
+            ELSE 0
+        END AS sell_fee
+    FROM trades
+),
+cum AS (
+    SELECT
+        *,
+        SUM(CASE WHEN transaction_type = 'BUY' THEN qty ELSE 0 END) OVER w AS bought,
+        SUM(CASE WHEN transaction_type = 'SELL' THEN qty ELSE 0 END) OVER w AS sold
+    FROM legs
+    WINDOW w AS (PARTITION BY trade_pair ORDER BY timestamp, id ROWS UNBOUNDED PRECEDING)
+),
+totals AS (
+    SELECT trade_pair, MAX(sold) AS sold, SUM(sold > bought) AS unmatched
+    FROM cum
+    GROUP BY trade_pair
+)
+SELECT
+    c.trade_pair,
+    c.price,
+    SUM(CASE
+        WHEN c.transaction_type = 'SELL' THEN c.qty
+        ELSE -MAX(0, MIN(c.bought, t.sold) - (c.bought - c.qty))
+    END) AS volume,
+    SUM(c.sell_fee) AS fee,
+    t.unmatched
+FROM cum c
+JOIN totals t ON t.trade_pair = c.trade_pair
+GROUP BY c.trade_pair, c.price, t.unmatched
+""".format(scale=10**SQL_FIXED_DIGITS))
+
+def calc_fifo_gains():
+    """
+    Get the FIFO gain per trade pair, calculated by SQLite.
+    A quick total without the per-match report of calc_fifo,
+    values are rounded to SQL_FIXED_DIGITS decimal places.
+    """
+    gains = defaultdict(int)
+    fees = defaultdict(int)
+    with Session() as session:
+        result = session.execute(FIFO_GAIN_SQL)
+        for (pair, price, volume, fee, unmatched) in result:
+            if unmatched:
+                raise ValueError(f"No BUY left to match SELL against ({pair})")
+            gains[pair] += price * volume
+            fees[pair] += fee
+
+    return {
+        pair: from_fixed(gain, 2 * SQL_FIXED_DIGITS) - from_fixed(fees[pair], SQL_FIXED_DIGITS)
+        for (pair, gain) in gains.items()
+    }
+
+# Amounts and prices from Bitpanda have at most 8 decimal places,
+# so the FIFO matching can be done with plain ints.
+FIXED_POINT_DIGITS = 10
+
+def to_fixed(value: D) -> int:
+    """
+    Scale a Decimal to an int with FIXED_POINT_DIGITS decimal places
+    """
+    scaled = value.scaleb(FIXED_POINT_DIGITS)
+    if scaled != scaled.to_integral_value():
+        raise ValueError(f"Too many decimal places for fixed point: {value}")
+    return int(scaled)
+
+def from_fixed(value: int, digits: int = FIXED_POINT_DIGITS) -> D:
+    """
+    Convert a fixed point int back to a Decimal
+    """
+    return D(value).scaleb(-digits)
+
+def _fifo_match_py(volume, is_sale):
+    """
+    FIFO matching of the trades of one trade pair.
+    volume is the fixed point volume of each trade, positive for BUY and SELL.
+    Returns (buy index, sell index, amount) of each match, ordered by sale.
+    """
+    # [index, remaining] of the BUYs, with head pointing to the oldest one not used up
+    buys = []
+    head = 0
+    matches = []
+    for (i, v) in enumerate(volume):
+        if not is_sale[i]:
+            buys.append([i, v])
+            continue
+
+        t_remaining = v
+        while t_remaining > 0:
+            if head == len(buys):
+                raise ValueError("No BUY left to match SELL against")
+            matching_trade = buys[head]
+
+            amnt = min(matching_trade[1], t_remaining)
+            matching_trade[1] -= amnt
+            t_remaining -= amnt
+            if matching_trade[1] == 0:
+                head += 1
+
+            matches.append((matching_trade[0], i, amnt))
+
+        # drop the used up BUYs now and then
+        if head > 1024:
+            del buys[:head]
+            head = 0
+    return matches
+
+def _fifo_match_kernel(volume, is_sale):
+    """
+    Same as _fifo_match_py, on int64 / bool arrays.
+    Returns three arrays: buy index, sell index, amount.
+    Compiled with numba by _load_fifo_match_jit.
+    """
+    n = len(volume)
+    # every match uses up either a BUY or the SELL, so there are at most n
+    match_buy = np.empty(n, np.int64)
+    match_sell = np.empty(n, np.int64)
+    match_amount = np.empty(n, np.int64)
+    k = 0
+
+    # BUYs in order, with head pointing to the oldest one not used up
+    buys = np.empty(n, np.int64)
+    remaining = volume.copy()
+    head = 0
+    tail = 0
+    for i in range(n):
+        if not is_sale[i]:
+            buys[tail] = i
+            tail += 1
+            continue
+
+        t_remaining = volume[i]
+        while t_remaining > 0:
+            if head == tail:
+                raise ValueError("No BUY left to match SELL against")
+            b = buys[head]
+            amnt = min(remaining[b], t_remaining)
+            remaining[b] -= amnt
+            t_remaining -= amnt
+            if remaining[b] == 0:
+                head += 1
+
+            match_buy[k] = b
+            match_sell[k] = i
+            match_amount[k] = amnt
+            k += 1
+    return match_buy[:k], match_sell[:k], match_amount[:k]
+
+# Optional: JIT compiled FIFO matching.
+# numpy and numba are only imported on first use, they take a while to load.
+np = None
+# None: not loaded yet, False: numba not available
+_fifo_match_jit = None
+
+def _load_fifo_match_jit():
+    """
+    Get the numba compiled _fifo_match_kernel, or None if numba isn't installed
+    """
+    global np, _fifo_match_jit
+
+    if _fifo_match_jit is None:
+        try:
+            import numpy
+            from numba import njit
+        except ImportError:
+            _fifo_match_jit = False
         else:
-            if t.trade_pair not in fifo:
-                fifo[t.trade_pair] = deque()
+            np = numpy
+            _fifo_match_jit = njit(cache=True)(_fifo_match_kernel)
+
+    if _fifo_match_jit is False:
+        return None
+    return _fifo_match_jit
+
+def fifo_match(volume, is_sale):
+    """
+    FIFO matching of the trades of one trade pair,
+    see _fifo_match_py. Uses numba if available.
+    """
+    fifo_match_jit = _load_fifo_match_jit()
+    if fifo_match_jit is None:
+        return _fifo_match_py(volume, is_sale)
+
+    try:
+        volume_arr = np.array(volume, dtype=np.int64)
+    except OverflowError:
+        # too large for int64 in fixed point
+        return _fifo_match_py(volume, is_sale)
 
-            q : deque = fifo.get(t.trade_pair)
-            t.remaining = t.balance_left
-            q.append(t)
-    print(f"TOTAL GAIN: {allgain}")
+    (buy, sell, amount) = fifo_match_jit(volume_arr, np.array(is_sale, dtype=np.bool_))
+    return zip(buy.tolist(), sell.tolist(), amount.tolist())
+
+def calc_fifo():
+    # trades of each trade pair, as lists of columns, in fixed point
+    pairs=defaultdict(lambda: {
+        "index": [], "is_sale": [], "volume": [],
+        "amount": [], "price": [], "fee": []
+    })
+    for (i, t) in enumerate(get_trade_rows()):
+        p = pairs[t.trade_pair]
+
+        is_sale = t.transaction_type == "SELL"
+        p["index"].append(i)
+        p["is_sale"].append(is_sale)
+        # invert sign to be positive for sales
+        p["volume"].append(to_fixed(abs(trade_balance_left(t))))
+        p["amount"].append(to_fixed(t.amount))
+        p["price"].append(to_fixed(t.price))
+        # fee of a sale is on the fiat, and is shared by all matches
+        p["fee"].append(to_fixed(t.fee) if is_sale and not t.is_best_fee else 0)
+
+    # (index of sale, trade pair, buy, sell, amount), buy and sell indexing into the trade pair
+    matches=[]
+    for (trade_pair, p) in pairs.items():
+        for (b, s, amnt) in fifo_match(p["volume"], p["is_sale"]):
+            matches.append((p["index"][s], trade_pair, b, s, amnt))
+    # back into chronological order, stable within a sale
+    matches.sort(key=lambda m: m[0])
+
+    # sum of (sell - buy), in fixed point with twice the digits
+    allgain_fixed = 0
+    allfees = D()
+    for (_, trade_pair, b, s, amnt) in matches:
+        p = pairs[trade_pair]
+        buy = p["price"][b] * amnt
+        sell = p["price"][s] * amnt
+        # TODO
+        fees = D()
+        if p["fee"][s]:
+            fees = from_fixed(D(amnt * p["fee"][s]) / p["amount"][s])
+
+        allgain_fixed += sell - buy
+        allfees += fees
+
+        (amnt, buy, sell) = (from_fixed(amnt), from_fixed(buy, 2 * FIXED_POINT_DIGITS), from_fixed(sell, 2 * FIXED_POINT_DIGITS))
+        print(f"CURRENCY: {trade_pair.split('_')[0]}\tAMOUNT: {amnt:10.3f}\tBUY: {buy:10.3f} EUR\tSELL: {sell:10.3f} EUR\tFEE: {fees:10.3f} EUR\tGAIN: {(sell - buy - fees):10.3f} EUR")
+
+    allgain = from_fixed(allgain_fixed, 2 * FIXED_POINT_DIGITS) - allfees
+    print(f"TOTAL GAIN: {allgain.normalize():f}")